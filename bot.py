@@ -1,13 +1,15 @@
 import os
+import json
 import logging
+from cachetools import TTLCache
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
-from firebase_admin import credentials, firestore, initialize_app
+from firebase_admin import credentials, firestore_async, initialize_app
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore import AsyncClient
+from google.cloud.firestore_v1.base_query import FieldFilter
 from dotenv import load_dotenv
 
-# Load environment variables
-load_dotenv()
-
 # Set up logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -15,21 +17,76 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize Firebase
-try:
-    cred = credentials.Certificate("serviceAccountKey.json")
-    firebase_app = initialize_app(cred)
-    db = firestore.client()
-    logger.info("Firebase initialized successfully")
-except Exception as e:
-    logger.error(f"Error initializing Firebase: {e}")
-    raise
-
-# Telegram Bot Token
-BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-if not BOT_TOKEN:
-    logger.error("TELEGRAM_BOT_TOKEN environment variable is not set")
-    raise ValueError("TELEGRAM_BOT_TOKEN environment variable is not set")
+# Shared Firestore client, created on first use by get_db()
+db = None
+
+def _init_firebase() -> AsyncClient:
+    """Initialize Firebase and return the async Firestore client."""
+    try:
+        # Parse the service account key once and build the credential from the dict
+        with open("serviceAccountKey.json") as f:
+            service_account_info = json.load(f)
+        cred = credentials.Certificate(service_account_info)
+        firebase_app = initialize_app(cred)
+        # One Firestore client is created per process and shared by all handlers
+        client = firestore_async.client(firebase_app)
+        logger.info("Firebase initialized successfully")
+        return client
+    except Exception as e:
+        logger.error("Error initializing Firebase: %s", e)
+        raise
+
+def get_db() -> AsyncClient:
+    """Return the shared Firestore client, initializing Firebase if needed."""
+    global db
+    if db is None:
+        db = _init_firebase()
+    return db
+
+# Reply keyboard and message templates, built once and shared by all handlers
+SHARE_CONTACT_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton("Share Phone Number", request_contact=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+START_MSG = (
+    "Welcome to Dopamine Quiz Bot! 👋\n\n"
+    "To verify your phone number, please share your contact using the button below."
+)
+
+VERIFY_OK_MSG = (
+    "✅ Your phone number has been verified successfully!\n\n"
+    "You can now return to the website to continue."
+)
+
+NO_PENDING_MSG = (
+    "No pending verification found for this phone number. "
+    "Please start the verification process from the website first."
+)
+
+HELP_MSG = (
+    "🤖 *Dopamine Quiz Bot Help*\n\n"
+    "This bot helps verify your phone number for the Dopamine Quiz website.\n\n"
+    "*How to use:*\n"
+    "1. Start the verification process on the website\n"
+    "2. Click the 'Verify via Telegram' button\n"
+    "3. This bot will automatically verify your phone number\n\n"
+    "If you have any issues, please contact support."
+)
+
+STATUS_VERIFIED_MSG = (
+    "✅ Your phone number is already verified!\n\n"
+    "You can return to the website to continue."
+)
+
+STATUS_UNVERIFIED_MSG = (
+    "Your phone number is not yet verified.\n\n"
+    "Please start the verification process from the website first."
+)
+
+# Short-lived cache of Telegram user ids known to be verified, for /status
+_status_cache = TTLCache(maxsize=10_000, ttl=30)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
@@ -42,24 +99,42 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await handle_verification(update, context, verification_code)
         else:
             # Ask for phone number if no verification code provided
-            keyboard = [[KeyboardButton("Share Phone Number", request_contact=True)]]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-            
-            await update.message.reply_text(
-                "Welcome to Dopamine Quiz Bot! 👋\n\n"
-                "To verify your phone number, please share your contact using the button below.",
-                reply_markup=reply_markup
-            )
+            await update.message.reply_text(START_MSG, reply_markup=SHARE_CONTACT_MARKUP)
     except Exception as e:
-        logger.error(f"Error in start command: {e}")
+        logger.error("Error in start command: %s", e)
         await update.message.reply_text("An error occurred. Please try again.")
 
+async def _finalize_verification(update: Update, user_ids: list, verification_refs: list) -> None:
+    """Mark users as verified, delete their verification codes and confirm to the user."""
+    client = get_db()
+    batch = client.batch()
+    
+    # Update user documents in Firestore to mark phone as verified
+    for user_id in user_ids:
+        batch.update(client.collection('users').document(user_id), {
+            'phoneVerified': True,
+            'telegramUsername': update.effective_user.username,
+            'telegramId': update.effective_user.id
+        })
+    
+    # Delete the verification codes to prevent reuse. These ride in the same
+    # batch commit, so they add no round-trip before the success reply.
+    for verification_ref in verification_refs:
+        batch.delete(verification_ref)
+    
+    # Commit all writes atomically in a single RPC; update() fails with
+    # NotFound if a user document does not exist
+    await batch.commit()
+    _status_cache[update.effective_user.id] = True
+    
+    await update.message.reply_text(VERIFY_OK_MSG)
+
 async def handle_verification(update: Update, context: ContextTypes.DEFAULT_TYPE, verification_code: str) -> None:
     """Handle verification code from the start command."""
     try:
         # Look up the verification code in Firestore
-        verification_ref = db.collection('telegramVerifications').document(verification_code)
-        verification_doc = verification_ref.get()
+        verification_ref = get_db().collection('telegramVerifications').document(verification_code)
+        verification_doc = await verification_ref.get(field_paths=['userId'])
         
         if not verification_doc.exists:
             await update.message.reply_text("Invalid verification code. Please try again from the website.")
@@ -67,39 +142,21 @@ async def handle_verification(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         verification_data = verification_doc.to_dict()
         user_id = verification_data.get('userId')
-        phone_number = verification_data.get('phone')
         
         if not user_id:
             await update.message.reply_text("Invalid verification data. Please try again from the website.")
             return
         
-        # Get the user document to check if it exists
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
+        try:
+            await _finalize_verification(update, [user_id], [verification_ref])
+        except NotFound:
             await update.message.reply_text("User not found. Please try again from the website.")
             return
         
-        # Update user document in Firestore to mark phone as verified
-        await user_ref.update({
-            'phoneVerified': True,
-            'telegramUsername': update.effective_user.username,
-            'telegramId': update.effective_user.id
-        })
-        
-        # Delete the verification code to prevent reuse
-        verification_ref.delete()
-        
-        await update.message.reply_text(
-            "✅ Your phone number has been verified successfully!\n\n"
-            "You can now return to the website to continue."
-        )
-        
-        logger.info(f"User {user_id} verified successfully via code {verification_code}")
+        logger.info("User %s verified successfully via code %s", user_id, verification_code)
         
     except Exception as e:
-        logger.error(f"Error in handle_verification: {e}")
+        logger.error("Error in handle_verification: %s", e)
         await update.message.reply_text("An error occurred during verification. Please try again.")
 
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -108,7 +165,8 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         contact = update.message.contact
         user_id = contact.user_id
         
-        if user_id and user_id != update.effective_user.id:
+        # Contacts shared from someone else's card may carry no user_id at all
+        if not user_id or user_id != update.effective_user.id:
             await update.message.reply_text("Please share your own contact information.")
             return
         
@@ -117,104 +175,142 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text("No phone number found in contact.")
             return
         
-        # Format phone number to standard format (remove + if present for comparison)
-        formatted_phone = phone_number.lstrip('+')
+        # Normalize phone number to digits only (strip +, spaces and dashes) for an exact match
+        formatted_phone = ''.join(c for c in phone_number if c.isdigit())
         
         # Check if this phone number exists in any pending verification
-        verifications_ref = db.collection('telegramVerifications')
-        query = verifications_ref.where('phone', '>=', formatted_phone).where('phone', '<=', formatted_phone + '\uf8ff').stream()
+        verifications_ref = get_db().collection('telegramVerifications')
+        query = verifications_ref.where(filter=FieldFilter('phone', '==', formatted_phone)).select(['userId']).stream()
         
-        found = False
-        for doc in query:
+        verified_user_ids = []
+        verification_refs = []
+        async for doc in query:
             verification_data = doc.to_dict()
             user_id = verification_data.get('userId')
             
             if not user_id:
                 continue
-                
-            # Update user document
-            user_ref = db.collection('users').document(user_id)
-            await user_ref.update({
-                'phoneVerified': True,
-                'telegramUsername': update.effective_user.username,
-                'telegramId': update.effective_user.id
-            })
             
-            # Delete the verification document
-            doc.reference.delete()
+            verification_refs.append(doc.reference)
             
-            found = True
-            logger.info(f"User {user_id} verified successfully via contact sharing")
-        
-        if found:
-            await update.message.reply_text(
-                "✅ Your phone number has been verified successfully!\n\n"
-                "You can now return to the website to continue."
-            )
-        else:
-            await update.message.reply_text(
-                "No pending verification found for this phone number. "
-                "Please start the verification process from the website first."
-            )
+            # Retried verifications for the same user only need one user update
+            if user_id not in verified_user_ids:
+                verified_user_ids.append(user_id)
+        
+        if not verified_user_ids:
+            await update.message.reply_text(NO_PENDING_MSG)
+            return
+        
+        try:
+            await _finalize_verification(update, verified_user_ids, verification_refs)
+        except NotFound:
+            # A missing user document aborts the whole batch; keep only users that
+            # still exist. Every matched verification is deleted either way, so
+            # orphaned ones do not fail the same batch on every later share.
+            client = get_db()
+            user_refs = [client.collection('users').document(user_id) for user_id in verified_user_ids]
+            existing = {snap.id async for snap in client.get_all(user_refs, field_paths=[]) if snap.exists}
+            verified_user_ids = [user_id for user_id in verified_user_ids if user_id in existing]
+            
+            if not verified_user_ids:
+                batch = client.batch()
+                for verification_ref in verification_refs:
+                    batch.delete(verification_ref)
+                await batch.commit()
+                await update.message.reply_text("User not found. Please try again from the website.")
+                return
+            
+            # A user deleted between get_all and this retry raises NotFound again;
+            # that race is left to the generic error reply below
+            await _finalize_verification(update, verified_user_ids, verification_refs)
+        
+        for user_id in verified_user_ids:
+            logger.info("User %s verified successfully via contact sharing", user_id)
             
     except Exception as e:
-        logger.error(f"Error in handle_contact: {e}")
+        logger.error("Error in handle_contact: %s", e)
         await update.message.reply_text("An error occurred while processing your contact. Please try again.")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
     try:
-        await update.message.reply_text(
-            "🤖 *Dopamine Quiz Bot Help*\n\n"
-            "This bot helps verify your phone number for the Dopamine Quiz website.\n\n"
-            "*How to use:*\n"
-            "1. Start the verification process on the website\n"
-            "2. Click the 'Verify via Telegram' button\n"
-            "3. This bot will automatically verify your phone number\n\n"
-            "If you have any issues, please contact support.",
-            parse_mode='Markdown'
-        )
+        await update.message.reply_text(HELP_MSG, parse_mode='Markdown')
     except Exception as e:
-        logger.error(f"Error in help_command: {e}")
+        logger.error("Error in help_command: %s", e)
+
+async def _lookup_phone_verified(telegram_id: int) -> bool:
+    """Return whether any user linked to a Telegram id has a verified phone."""
+    # A single projected query against users, which the website owns: a uid later
+    # re-verified from another Telegram account no longer matches this id.
+    query = (
+        get_db().collection('users')
+        .where(filter=FieldFilter('telegramId', '==', telegram_id))
+        .where(filter=FieldFilter('phoneVerified', '==', True))
+        .select(['phoneVerified'])
+        .limit(1)
+    )
+    docs = await query.get()
+    return bool(docs)
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Check verification status."""
     try:
-        # Check if user exists in our database
         user_id = update.effective_user.id
-        users_ref = db.collection('users')
-        query = users_ref.where('telegramId', '==', user_id).stream()
+        verified = user_id in _status_cache
         
-        verified = False
-        for doc in query:
-            user_data = doc.to_dict()
-            if user_data.get('phoneVerified'):
-                verified = True
-                break
+        if not verified:
+            verified = await _lookup_phone_verified(user_id)
+            # Only cache positive results: a stale False could overwrite a True
+            # seeded by a concurrent verification, or hide one on another replica
+            if verified:
+                _status_cache[user_id] = True
         
         if verified:
-            await update.message.reply_text(
-                "✅ Your phone number is already verified!\n\n"
-                "You can return to the website to continue."
-            )
+            await update.message.reply_text(STATUS_VERIFIED_MSG)
         else:
-            await update.message.reply_text(
-                "Your phone number is not yet verified.\n\n"
-                "Please start the verification process from the website first."
-            )
+            await update.message.reply_text(STATUS_UNVERIFIED_MSG)
             
     except Exception as e:
-        logger.error(f"Error in status_command: {e}")
+        logger.error("Error in status_command: %s", e)
         await update.message.reply_text("An error occurred while checking your status. Please try again.")
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log errors caused by Updates."""
-    logger.error(f"Exception while handling an update: {context.error}", exc_info=context.error)
+    logger.error("Exception while handling an update: %s", context.error, exc_info=context.error)
 
 def main() -> None:
     """Start the bot."""
+    # Load environment variables
+    load_dotenv()
+
+    # Telegram Bot Token
+    bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not bot_token:
+        logger.error("TELEGRAM_BOT_TOKEN environment variable is not set")
+        raise ValueError("TELEGRAM_BOT_TOKEN environment variable is not set")
+
+    # Public base URL for webhook mode; long polling is used when unset
+    webhook_url = os.getenv('WEBHOOK_URL')
+
+    # Initialize Firebase before accepting updates so misconfiguration fails fast
+    get_db()
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Up to 256 updates are handled concurrently. Outbound requests and
+    # getUpdates use separate connection pools so replies never wait on the
+    # long-poll connection.
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .concurrent_updates(256)
+        .connection_pool_size(32)
+        .pool_timeout(30.0)
+        .connect_timeout(10.0)
+        .read_timeout(20.0)
+        .get_updates_connection_pool_size(4)
+        .get_updates_pool_timeout(30.0)
+        .build()
+    )
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -227,7 +323,18 @@ def main() -> None:
 
     # Run the bot until the user presses Ctrl-C
     logger.info("Bot started successfully")
-    application.run_polling()
+    if webhook_url:
+        # Let Telegram push updates so multiple replicas can serve them in parallel
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=int(os.getenv('PORT', 8443)),
+            url_path=bot_token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{bot_token}",
+            secret_token=os.getenv('WEBHOOK_SECRET')
+        )
+    else:
+        # Fall back to long polling for local development
+        application.run_polling()
 
 if __name__ == "__main__":
     main()